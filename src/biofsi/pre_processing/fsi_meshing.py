@@ -1,23 +1,11 @@
 import argparse
 import sys
-from os import remove, path, listdir
+from os import remove, path, listdir, cpu_count, scandir
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from morphman import is_surface_capped, get_uncapped_surface, write_polydata, get_parameters, vtk_clean_polydata, \
-    vtk_triangulate_surface, write_parameters, vmtk_cap_polydata, compute_centerlines, get_centerline_tolerance, \
-    get_vtk_point_locator, extract_single_line, vtk_merge_polydata, get_point_data_array, smooth_voronoi_diagram, \
-    create_new_surface, compute_centers, vmtk_smooth_surface, str2bool, vmtk_compute_voronoi_diagram
 
-from vampy.automatedPreprocessing import ToolRepairSTL
-from vampy.automatedPreprocessing.preprocessing_common import read_polydata, get_centers_for_meshing, \
-     dist_sphere_diam, dist_sphere_curvature, dist_sphere_constant, get_regions_to_refine, add_flow_extension, \
-    mesh_alternative, find_boundaries, \
-    compute_flow_rate, setup_model_network, radiusArrayName
-
-from vampy.automatedPreprocessing.visualize import visualize_model
-
-from pre_processing_common import scale_surface, scale_mesh, generate_mesh_fsi, write_mesh
 
 def str2bool(boolean):
     """Convert a string to boolean.
@@ -37,7 +25,7 @@ def str2bool(boolean):
 def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothing_factor, meshing_method,
                        refine_region, create_flow_extensions, viz, coarsening_factor,
                        inlet_flow_extension_length, outlet_flow_extension_length, edge_length, region_points,
-                       compress_mesh, scale_factor):
+                       compress_mesh, scale_factor, mesh_format):
     """
     Run the pre-processing steps for the FSI model.
     Args:
@@ -55,32 +43,59 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
         edge_length (float): Edge length.
         region_points (int): Position of the refinement region.
         compress_mesh (bool): Compress the mesh.
+        scale_factor (float): Scale the mesh by this factor.
+        mesh_format (str): Format of the volumetric mesh, either DOLFIN XML ("xml") or XDMF with HDF5 data ("xdmf").
     Returns:
         None (volumential mesh is written to the same folder as the input model)
     """
+    # Heavy modules (VTK, VMTK, morphMan, VaMPy) are imported here, so that the command line interface loads fast
+    from scipy.spatial import cKDTree
+    from vtk.util.numpy_support import vtk_to_numpy
+    from morphman import is_surface_capped, get_uncapped_surface, get_parameters, vtk_clean_polydata, \
+        vtk_triangulate_surface, write_parameters, vmtk_cap_polydata, compute_centerlines, get_centerline_tolerance, \
+        extract_single_line, vtk_merge_polydata, smooth_voronoi_diagram, \
+        create_new_surface, compute_centers, vmtk_smooth_surface, vmtk_compute_voronoi_diagram
+
+    from vampy.automatedPreprocessing import ToolRepairSTL
+    from vampy.automatedPreprocessing.preprocessing_common import read_polydata, get_centers_for_meshing, \
+        dist_sphere_diam, dist_sphere_curvature, dist_sphere_constant, get_regions_to_refine, add_flow_extension, \
+        mesh_alternative, find_boundaries, \
+        compute_flow_rate, setup_model_network, radiusArrayName
+
+    from vampy.automatedPreprocessing.visualize import visualize_model
+
+    from pre_processing_common import scale_surface, scale_mesh, generate_mesh_fsi, write_mesh, get_cached_polydata, \
+        write_polydata_in_background, write_xml_data
+
     # Get paths
     abs_path = path.abspath(path.dirname(__file__))
     case_name = filename_model.rsplit(path.sep, 1)[-1].rsplit('.')[0]
     dir_path = filename_model.rsplit(path.sep, 1)[0]
 
     # Naming conventions
-    file_name_centerlines = path.join(dir_path, case_name + "_centerlines.vtp")
-    file_name_refine_region_centerlines = path.join(dir_path, case_name + "_refine_region_centerline.vtp")
-    file_name_region_centerlines = path.join(dir_path, case_name + "_sac_centerline_{}.vtp")
-    file_name_distance_to_sphere_diam = path.join(dir_path, case_name + "_distance_to_sphere_diam.vtp")
-    file_name_distance_to_sphere_const = path.join(dir_path, case_name + "_distance_to_sphere_const.vtp")
-    file_name_distance_to_sphere_curv = path.join(dir_path, case_name + "_distance_to_sphere_curv.vtp")
-    file_name_probe_points = path.join(dir_path, case_name + "_probe_point")
-    file_name_voronoi = path.join(dir_path, case_name + "_voronoi.vtp")
-    file_name_voronoi_smooth = path.join(dir_path, case_name + "_voronoi_smooth.vtp")
-    file_name_surface_smooth = path.join(dir_path, case_name + "_smooth.vtp")
-    file_name_model_flow_ext = path.join(dir_path, case_name + "_flowext.vtp")
-    file_name_clipped_model = path.join(dir_path, case_name + "_clippedmodel.vtp")
-    file_name_flow_centerlines = path.join(dir_path, case_name + "_flow_cl.vtp")
-    file_name_surface_name = path.join(dir_path, case_name + "_remeshed_surface.vtp")
-    file_name_xml_mesh = path.join(dir_path, case_name + "_fsi.xml")
-    file_name_vtu_mesh = path.join(dir_path, case_name + "_fsi.vtu")
-    file_name_run_script = path.join(dir_path, case_name + ".sh")
+    prefix = path.join(dir_path, case_name)
+    file_name_centerlines = f"{prefix}_centerlines.vtp"
+    file_name_refine_region_centerlines = f"{prefix}_refine_region_centerline.vtp"
+    file_name_region_centerlines = f"{prefix}_sac_centerline_{{}}.vtp"
+    file_name_distance_to_sphere_diam = f"{prefix}_distance_to_sphere_diam.vtp"
+    file_name_distance_to_sphere_const = f"{prefix}_distance_to_sphere_const.vtp"
+    file_name_distance_to_sphere_curv = f"{prefix}_distance_to_sphere_curv.vtp"
+    file_name_probe_points = f"{prefix}_probe_point"
+    file_name_voronoi = f"{prefix}_voronoi.vtp"
+    file_name_voronoi_smooth = f"{prefix}_voronoi_smooth.vtp"
+    file_name_surface_smooth = f"{prefix}_smooth.vtp"
+    file_name_model_flow_ext = f"{prefix}_flowext.vtp"
+    file_name_clipped_model = f"{prefix}_clippedmodel.vtp"
+    file_name_flow_centerlines = f"{prefix}_flow_cl.vtp"
+    file_name_surface_name = f"{prefix}_remeshed_surface.vtp"
+    file_name_xml_mesh = f"{prefix}_fsi.xml"
+    file_name_xdmf_mesh = f"{prefix}_fsi.xdmf"
+    file_name_vtu_mesh = f"{prefix}_fsi.vtu"
+    file_name_run_script = f"{prefix}.sh"
+
+    # Files from previous runs, listed once instead of checking each file separately
+    with scandir(dir_path) as entries:
+        existing_files = set(entry.name for entry in entries if entry.is_file())
 
     print("\n--- Working on case:", case_name, "\n")
 
@@ -90,18 +105,17 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
 
     # Check if surface is closed and uncapps model if True
     if is_surface_capped(surface)[0] and smoothing_method != "voronoi":
-        if not path.isfile(file_name_clipped_model):
+        def clip_surface():
             print("--- Clipping the models inlets and outlets.\n")
             # TODO: Add input parameters as input to automatedPreProcessing
             # Value of gradients_limit should be generally low, to detect flat surfaces corresponding
             # to closed boundaries. Area_limit will set an upper limit of the detected area, may vary between models.
             # The circleness_limit parameters determines the detected regions similarity to a circle, often assumed
             # to be close to a circle.
-            surface = get_uncapped_surface(surface, gradients_limit=0.01, area_limit=20, circleness_limit=5)
-            write_polydata(surface, file_name_clipped_model)
-        else:
-            surface = read_polydata(file_name_clipped_model)
-    parameters = get_parameters(path.join(dir_path, case_name))
+            return get_uncapped_surface(surface, gradients_limit=0.01, area_limit=20, circleness_limit=5)
+
+        surface = get_cached_polydata(file_name_clipped_model, clip_surface, existing_files)
+    parameters = get_parameters(prefix)
 
     if "check_surface" not in parameters.keys():
         surface = vtk_clean_polydata(surface)
@@ -109,148 +123,167 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
 
         # Check the mesh if there is redundant nodes or NaN triangles.
         ToolRepairSTL.surfaceOverview(surface)
-        ToolRepairSTL.foundAndDeleteNaNTriangles(surface)
-        surface = ToolRepairSTL.cleanTheSurface(surface)
         foundNaN = ToolRepairSTL.foundAndDeleteNaNTriangles(surface)
+        surface = ToolRepairSTL.cleanTheSurface(surface)
+        # Cleaning cannot introduce NaN triangles, so only scan again if some were removed
+        if foundNaN:
+            foundNaN = ToolRepairSTL.foundAndDeleteNaNTriangles(surface)
         if foundNaN:
             raise RuntimeError(("There is an issue with the surface. "
                                 "Nan coordinates or some other shenanigans."))
         else:
             parameters["check_surface"] = True
-            write_parameters(parameters, path.join(dir_path, case_name))
+            write_parameters(parameters, prefix)
         
     # Create a capped version of the surface
     capped_surface = vmtk_cap_polydata(surface)
 
     # Get centerlines
     print("--- Get centerlines\n")
-    inlet, outlets = get_centers_for_meshing(surface, False, path.join(dir_path, case_name))
+    inlet, outlets = get_centers_for_meshing(surface, False, prefix)
     source = inlet
     target = outlets
 
-    centerlines, _, _ = compute_centerlines(source, target, file_name_centerlines, capped_surface, resampling=0.1)
-    tol = get_centerline_tolerance(centerlines)
-
-    # Get 'center' and 'radius' of the regions(s)
-    region_center = []
-    misr_max = []
-    
     if refine_region:
-        regions = get_regions_to_refine(capped_surface, region_points, path.join(dir_path, case_name))
+        regions = get_regions_to_refine(capped_surface, region_points, prefix)
         for i in range(len(regions) // 3):
             print("--- Region to refine ({}): {:.3f} {:.3f} {:.3f}"
                     .format(i + 1, regions[3 * i], regions[3 * i + 1], regions[3 * i + 2]))
 
-        centerlineAnu, _, _ = compute_centerlines(source, regions, file_name_refine_region_centerlines, capped_surface,
+    if refine_region and not (path.basename(file_name_centerlines) in existing_files and
+                              path.basename(file_name_refine_region_centerlines) in existing_files):
+        # Compute the centerlines to the outlets and to the regions in one call, so that the Voronoi diagram is
+        # only computed once. There is one line per target point, in the order of the target points.
+        all_centerlines, _, _ = compute_centerlines(source, list(target) + list(regions), None, capped_surface,
                                                     resampling=0.1)
+        num_outlets = len(target) // 3
+        centerlines = vtk_merge_polydata([extract_single_line(all_centerlines, i) for i in range(num_outlets)])
+        centerlineAnu = vtk_merge_polydata([extract_single_line(all_centerlines, i)
+                                            for i in range(num_outlets, all_centerlines.GetNumberOfLines())])
+        write_xml_data(centerlines, file_name_centerlines)
+        write_xml_data(centerlineAnu, file_name_refine_region_centerlines)
+    else:
+        centerlines, _, _ = compute_centerlines(source, target, file_name_centerlines, capped_surface, resampling=0.1)
+        if refine_region:
+            centerlineAnu = read_polydata(file_name_refine_region_centerlines)
 
-        # Extract the region centerline
-        refine_region_centerline = []
-        info = get_parameters(path.join(dir_path, case_name))
-        num_anu = info["number_of_regions"]
-
-        # Compute mean distance between points
-        for i in range(num_anu):
-            if not path.isfile(file_name_region_centerlines.format(i)):
-                line = extract_single_line(centerlineAnu, i)
-                locator = get_vtk_point_locator(centerlines)
-                for j in range(line.GetNumberOfPoints() - 1, 0, -1):
-                    point = line.GetPoints().GetPoint(j)
-                    ID = locator.FindClosestPoint(point)
-                    tmp_point = centerlines.GetPoints().GetPoint(ID)
-                    dist = np.sqrt(np.sum((np.asarray(point) - np.asarray(tmp_point)) ** 2))
-                    if dist <= tol:
-                        break
-
-                tmp = extract_single_line(line, 0, start_id=j)
-                write_polydata(tmp, file_name_region_centerlines.format(i))
-
-                # List of VtkPolyData sac(s) centerline
-                refine_region_centerline.append(tmp)
+    tol = get_centerline_tolerance(centerlines)
 
-            else:
-                refine_region_centerline.append(read_polydata(file_name_region_centerlines.format(i)))
+    # Get 'center' and 'radius' of the regions(s)
+    region_center = []
+    misr_max = []
+
+    if refine_region:
+        # Extract the region centerline
+        num_anu = len(regions) // 3
+
+        # Search tree over the centerline points, shared by all regions
+        centerline_tree = cKDTree(vtk_to_numpy(centerlines.GetPoints().GetData()))
+
+        def extract_region_centerline(i):
+            """
+            Extract the part of the i-th region centerline that is not shared with the model centerlines.
+            Args:
+                i (int): Index of the region.
+            Returns:
+                region_centerline (vtkPolyData): Centerline of the region.
+            """
+            line = extract_single_line(centerlineAnu, i)
+
+            # Find the last point (excluding the first) within tol of the centerlines. The tree compares
+            # squared distances internally and stops searching beyond tol, returning inf for those points.
+            line_points = vtk_to_numpy(line.GetPoints().GetData())
+            dist, _ = centerline_tree.query(line_points[1:], distance_upper_bound=np.nextafter(tol, np.inf))
+            inside = np.isfinite(dist)
+            j = len(line_points) - 1 - int(np.argmax(inside[::-1])) if inside.any() else 1
+
+            return extract_single_line(line, 0, start_id=j)
+
+        def get_region_centerline(i):
+            """
+            Read the i-th region centerline from file, or extract and write it if it does not exist.
+            Args:
+                i (int): Index of the region.
+            Returns:
+                region_centerline (vtkPolyData): Centerline of the region.
+            """
+            return get_cached_polydata(file_name_region_centerlines.format(i), lambda: extract_region_centerline(i),
+                                       existing_files)
+
+        # The regions are independent, so run them in threads. extract_single_line is a per-point Python loop
+        # holding the GIL, so the threads mainly overlap the kd-tree queries and the file reading and writing.
+        # The cell structure is built up front, since VTK would otherwise build it lazily from several threads.
+        centerlineAnu.BuildCells()
+
+        # List of VtkPolyData sac(s) centerline, in the same order as the regions.
+        with ThreadPoolExecutor(max_workers=max(1, min(num_anu, cpu_count() or 1))) as executor:
+            refine_region_centerline = list(executor.map(get_region_centerline, range(num_anu)))
 
         # Merge the sac centerline
         region_centerlines = vtk_merge_polydata(refine_region_centerline)
 
         for region in refine_region_centerline:
-            region_factor = 0.5
-            region_center.append(region.GetPoints().GetPoint(int(region.GetNumberOfPoints() * region_factor)))
-            tmp_misr = get_point_data_array(radiusArrayName, region)
+            # Center of the region is the midpoint of its centerline
+            region_center.append(region.GetPoints().GetPoint(region.GetNumberOfPoints() // 2))
+            tmp_misr = vtk_to_numpy(region.GetPointData().GetArray(radiusArrayName))
             misr_max.append(tmp_misr.max())
     
     # Smooth surface
     if smoothing_method == "voronoi":
         print("--- Smooth surface: Voronoi smoothing\n")
-        if not path.isfile(file_name_surface_smooth):
-            # Get Voronoi diagram
-            if not path.isfile(file_name_voronoi):
-                voronoi = vmtk_compute_voronoi_diagram(surface, file_name_voronoi)
-                write_polydata(voronoi, file_name_voronoi)
-            else:
-                voronoi = read_polydata(file_name_voronoi)
 
-            # Get smooth Voronoi diagram
-            if not path.isfile(file_name_voronoi_smooth):
-                if refine_region:
-                    smooth_voronoi = smooth_voronoi_diagram(voronoi, centerlines, smoothing_factor, region_centerlines)
-                else:
-                    smooth_voronoi = smooth_voronoi_diagram(voronoi, centerlines, smoothing_factor)
+        def voronoi_smooth_surface():
+            # Get Voronoi diagram (read from file_name_voronoi if it exists, otherwise computed and written to it)
+            voronoi = vmtk_compute_voronoi_diagram(surface, file_name_voronoi)
 
-                write_polydata(smooth_voronoi, file_name_voronoi_smooth)
-            else:
-                smooth_voronoi = read_polydata(file_name_voronoi_smooth)
+            # Get smooth Voronoi diagram
+            no_smooth_centerlines = region_centerlines if refine_region else None
+            smooth_voronoi = get_cached_polydata(
+                file_name_voronoi_smooth,
+                lambda: smooth_voronoi_diagram(voronoi, centerlines, smoothing_factor, no_smooth_centerlines),
+                existing_files)
 
             # Envelope the smooth surface
-            surface = create_new_surface(smooth_voronoi)
+            smooth_surface = create_new_surface(smooth_voronoi)
 
             # Uncapp the surface
-            surface_uncapped = get_uncapped_surface(surface)
+            surface_uncapped = get_uncapped_surface(smooth_surface)
 
             # Check if there has been added new outlets
             num_outlets = centerlines.GetNumberOfLines()
             inlets, outlets = compute_centers(surface_uncapped)
             num_outlets_after = len(outlets) // 3
 
+            # The Laplace smoothing below only runs before exiting, so the surface is never smoothed twice
             if num_outlets != num_outlets_after:
-                surface = vmtk_smooth_surface(surface, "laplace", iterations=200)
-                write_polydata(surface, file_name_surface_smooth)
+                smooth_surface = vmtk_smooth_surface(smooth_surface, "laplace", iterations=200)
+                write_xml_data(smooth_surface, file_name_surface_smooth)
                 print(("ERROR: Automatic clipping failed. You have to open {} and " +
                        "manually clipp the branch which still is capped. " +
                        "Overwrite the current {} and restart the script.").format(
                     file_name_surface_smooth, file_name_surface_smooth))
                 sys.exit(0)
 
-            surface = surface_uncapped
-
             # Smoothing to improve the quality of the elements
             # Consider to add a subdivision here as well.
-            surface = vmtk_smooth_surface(surface, "laplace", iterations=200)
-
-            # Write surface
-            write_polydata(surface, file_name_surface_smooth)
+            return vmtk_smooth_surface(surface_uncapped, "laplace", iterations=200)
 
-        else:
-            surface = read_polydata(file_name_surface_smooth)
+        surface = get_cached_polydata(file_name_surface_smooth, voronoi_smooth_surface, existing_files)
 
     elif smoothing_method in ["laplace", "taubin"]:
         print("--- Smooth surface: {} smoothing\n".format(smoothing_method.capitalize()))
-        if not path.isfile(file_name_surface_smooth):
-            surface = vmtk_smooth_surface(surface, smoothing_method, iterations=400, passband=0.5)
-
-            # Save the smoothed surface
-            write_polydata(surface, file_name_surface_smooth)
-
-        else:
-            surface = read_polydata(file_name_surface_smooth)
+        surface = get_cached_polydata(
+            file_name_surface_smooth,
+            lambda: vmtk_smooth_surface(surface, smoothing_method, iterations=400, passband=0.5),
+            existing_files)
 
     elif smoothing_method == "no_smooth" or None:
         print("--- No smoothing of surface\n")
     
     # Add flow extensions
+    flow_ext_writer = None
     if create_flow_extensions:
-        if not path.isfile(file_name_model_flow_ext):
+        if path.basename(file_name_model_flow_ext) not in existing_files:
             print("--- Adding flow extensions\n")
             # Add extension normal on boundary for atrium models
             extension = "boundarynormal"
@@ -261,21 +294,23 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
                                                   extension_length=outlet_flow_extension_length)
 
             surface_extended = vmtk_smooth_surface(surface_extended, "laplace", iterations=200)
-            write_polydata(surface_extended, file_name_model_flow_ext)
+
+            # Write the surface while capping it and computing its centerlines below
+            flow_ext_writer = write_polydata_in_background(surface_extended, file_name_model_flow_ext)
         else:
             surface_extended = read_polydata(file_name_model_flow_ext)
     else:
         surface_extended = surface
 
-    # Capp surface with flow extensions
-    capped_surface = vmtk_cap_polydata(surface_extended)
-
     # Get new centerlines with the flow extensions
     if create_flow_extensions:
-        if not path.isfile(file_name_flow_centerlines):
+        if path.basename(file_name_flow_centerlines) not in existing_files:
             print("--- Compute the model centerlines with flow extension.\n")
+            # Capp surface with flow extensions, only needed for computing the centerlines
+            capped_surface = vmtk_cap_polydata(surface_extended)
+
             # Compute the centerlines.
-            inlet, outlets = get_centers_for_meshing(surface_extended, None, path.join(dir_path, case_name),
+            inlet, outlets = get_centers_for_meshing(surface_extended, None, prefix,
                                                      use_flow_extensions=True)
             # FIXME: There are several inlets and one outlet for atrium case
             source = inlet
@@ -286,30 +321,34 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
         else:
             centerlines = read_polydata(file_name_flow_centerlines)
 
+        # Wait for the flow extended surface to be written, raising any error from the write
+        if flow_ext_writer is not None:
+            flow_ext_writer.result()
+
       # Choose input for the mesh
     print("--- Computing distance to sphere\n")
     if meshing_method == "constant":
-        if not path.isfile(file_name_distance_to_sphere_const):
+        if path.basename(file_name_distance_to_sphere_const) not in existing_files:
             distance_to_sphere = dist_sphere_constant(surface_extended, centerlines, region_center, misr_max,
                                                       file_name_distance_to_sphere_const, edge_length)
         else:
             distance_to_sphere = read_polydata(file_name_distance_to_sphere_const)
 
     elif meshing_method == "curvature":
-        if not path.isfile(file_name_distance_to_sphere_curv):
+        if path.basename(file_name_distance_to_sphere_curv) not in existing_files:
             distance_to_sphere = dist_sphere_curvature(surface_extended, centerlines, region_center, misr_max,
                                                        file_name_distance_to_sphere_curv, coarsening_factor)
         else:
             distance_to_sphere = read_polydata(file_name_distance_to_sphere_curv)
     elif meshing_method == "diameter":
-        if not path.isfile(file_name_distance_to_sphere_diam):
+        if path.basename(file_name_distance_to_sphere_diam) not in existing_files:
             distance_to_sphere = dist_sphere_diam(surface_extended, centerlines, region_center, misr_max,
                                                   file_name_distance_to_sphere_diam, coarsening_factor)
         else:
             distance_to_sphere = read_polydata(file_name_distance_to_sphere_diam)
 
     # Compute mesh
-    if not path.isfile(file_name_vtu_mesh):
+    if path.basename(file_name_vtu_mesh) not in existing_files:
         try:
             print("--- Computing mesh\n")
             # TODO: TargetEdgeLength should not be hard coded
@@ -326,25 +365,28 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
             assert remeshed_surface.GetNumberOfPoints() > 0, \
                 "No points in surface mesh, try to remesh" 
         
-        if scale_factor is not None:
+        # Scaling by 1 leaves the points unchanged, so it is skipped
+        if scale_factor is not None and scale_factor != 1:
             remeshed_surface = scale_surface(remeshed_surface, scale_factor)
             mesh = scale_mesh(mesh, scale_factor)
 
         write_mesh(compress_mesh, file_name_surface_name, file_name_vtu_mesh, file_name_xml_mesh,
-                   mesh, remeshed_surface)
+                   mesh, remeshed_surface,
+                   file_name_xdmf_mesh=file_name_xdmf_mesh if mesh_format == "xdmf" else None)
 
     else:
         mesh = read_polydata(file_name_vtu_mesh)
 
     network, probe_points = setup_model_network(centerlines, file_name_probe_points, region_center, verbose_print)
 
-    # BSL method for mean inlet flow rate.
-    parameters = get_parameters(path.join(dir_path, case_name))
+    # BSL method for mean inlet flow rate. The parameters are read again since get_centers_for_meshing
+    # stores the inlet area in the parameter file.
+    parameters = get_parameters(prefix)
 
     print("--- Computing flow rates and flow split, and setting boundary IDs\n")
     mean_inflow_rate = compute_flow_rate(None, inlet, parameters)
 
-    find_boundaries(path.join(dir_path, case_name), mean_inflow_rate, network, mesh, verbose_print, None)
+    find_boundaries(prefix, mean_inflow_rate, network, mesh, verbose_print, None)
 
     # Display the flow split at the outlets, inlet flow rate, and probes.
     if viz:
@@ -358,9 +400,12 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
                        file_name_distance_to_sphere_curv, file_name_voronoi, file_name_voronoi_smooth,
                        file_name_surface_smooth, file_name_model_flow_ext, file_name_clipped_model,
                        file_name_flow_centerlines, file_name_surface_name]
-    for file in files_to_remove:
-        if path.exists(file):
-            remove(file)
+    # List the case directory once instead of checking each file separately
+    names_to_remove = set(path.basename(file) for file in files_to_remove)
+    with scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.name in names_to_remove:
+                remove(entry.path)
 
 def read_command_line():
     """
@@ -389,6 +434,15 @@ def read_command_line():
                         default=False,
                         help="Compress output mesh after generation.")
 
+    parser.add_argument('-mF', '--mesh-format',
+                        type=str,
+                        required=False,
+                        dest='meshFormat',
+                        default="xml",
+                        choices=["xml", "xdmf"],
+                        help="Format of the volumetric mesh: DOLFIN XML, or XDMF with the data stored in HDF5" +
+                             " and the boundary markers written to a separate _boundaries.xdmf file.")
+
     parser.add_argument('-sM', '--smoothingMethod',
                         type=str,
                         required=False,
@@ -494,7 +548,8 @@ def read_command_line():
                 refine_region=args.refineRegion, create_flow_extensions=args.flowExtension, viz=args.viz,
                 coarsening_factor=args.coarseningFactor, inlet_flow_extension_length=args.inletFlowExtLen,
                 edge_length=args.edgeLength, region_points=args.regionPoints, compress_mesh=args.compressMesh,
-                outlet_flow_extension_length=args.outletFlowExtLen, scale_factor=args.scale_factor)
+                outlet_flow_extension_length=args.outletFlowExtLen, scale_factor=args.scale_factor,
+                mesh_format=args.meshFormat)
 
 if __name__ == "__main__":
     
@@ -1,68 +1,91 @@
 from vmtkmeshgeneratorfsi import vmtkMeshGeneratorFsi
 import numpy as np
 import vtk
+from vtk.util.numpy_support import vtk_to_numpy
 from vmtk import vmtkscripts
-from morphman import write_polydata
+from morphman import read_polydata
+import gzip
+import shutil
+from os import path, remove, cpu_count
+from concurrent.futures import ThreadPoolExecutor
+
+# Block size used when writing large surfaces and meshes to disk
+block_size = 16 * 1024 * 1024
 
 def scale_surface(surface, scale_factor):
     """
-    Scale the input surface by a factor scale_factor.
+    Scale the input surface by a factor scale_factor. The points are scaled in place.
     Args:
         surface (vtkPolyData): Input surface to be scaled
         scale_factor (float): Scaling factor
     Returns:
         scaled_surface (vtkPolyData): Scaled input surface
     """
-    surface_scaler = vmtkscripts.vmtkSurfaceScaling()
-    surface_scaler.Surface = surface
-    surface_scaler.ScaleFactor = scale_factor
-    surface_scaler.Execute()
-
-    # Get scaled surface
-    scaled_surface = surface_scaler.Surface
+    points = surface.GetPoints()
+    coordinates = vtk_to_numpy(points.GetData())
+    coordinates *= scale_factor
+    points.Modified()
 
-    return scaled_surface
+    return surface
 
 def scale_mesh(mesh, scale_factor):
     """
-    Scale the input mesh by a factor scale_factor.
+    Scale the input mesh by a factor scale_factor. The points are scaled in place.
     Args:
         mesh (vtkUnstructuredGrid): Input mesh to be scaled
         scale_factor (float): Scaling factor
     Returns:
         scaled_mesh (vtkUnstructuredGrid): Scaled input mesh
     """
-    mesh_scaler = vmtkscripts.vmtkMeshScaling()
-    mesh_scaler.Mesh = mesh
-    mesh_scaler.ScaleFactor = scale_factor
-    mesh_scaler.Execute()
+    points = mesh.GetPoints()
+    coordinates = vtk_to_numpy(points.GetData())
+    coordinates *= scale_factor
+    points.Modified()
 
-    # Get scaled mesh
-    scaled_mesh = mesh_scaler.Mesh
+    return mesh
 
-    return scaled_mesh
+def scale_datasets(datasets, scale_factor):
+    """
+    Scale several surfaces or meshes by a factor scale_factor, in parallel. The points are scaled in place.
+    Each dataset is scaled once per occurrence in the list, so a dataset listed twice, or datasets sharing the
+    same vtkPoints, are scaled more than once, concurrently and with an undefined result.
+    Args:
+        datasets (list): Input surfaces (vtkPolyData) or meshes (vtkUnstructuredGrid) to be scaled
+        scale_factor (float): Scaling factor
+    Returns:
+        scaled_datasets (list): Scaled input datasets, in the same order
+    """
+    # NumPy releases the GIL while scaling, so threads run in parallel. Half of the cores limits memory traffic.
+    # scale_surface only uses GetPoints, so it scales meshes as well.
+    with ThreadPoolExecutor(max_workers=max(1, (cpu_count() or 1) // 2)) as executor:
+        return list(executor.map(lambda dataset: scale_surface(dataset, scale_factor), datasets))
 
 def generate_mesh_fsi(surface, Solid_thickness, TargetEdgeLength):
     """
     Generates a mesh suitable for FSI from a input surface model.
     Args:
         surface (vtkPolyData): Surface model to be meshed.
+        Solid_thickness (float): Thickness of the solid wall.
+        TargetEdgeLength (float): Target edge length of the mesh, must be positive.
     Returns:
         mesh (vtkUnstructuredGrid): Output mesh
         remeshedsurface (vtkPolyData): Remeshed version of the input model
     """
 
+    if TargetEdgeLength <= 0:
+        raise ValueError("TargetEdgeLength must be positive, got {}".format(TargetEdgeLength))
+
     # Parameters
     meshGenerator = vmtkMeshGeneratorFsi()
     meshGenerator.Surface = surface
     meshGenerator.ElementSizeMode = 'edgelength'
     meshGenerator.TargetEdgeLength = TargetEdgeLength
-    meshGenerator.MaxEdgeLength = 15*meshGenerator.TargetEdgeLength
-    meshGenerator.MinEdgeLength = 5*meshGenerator.TargetEdgeLength
+    meshGenerator.MaxEdgeLength = 15 * TargetEdgeLength
+    meshGenerator.MinEdgeLength = 5 * TargetEdgeLength
     meshGenerator.BoundaryLayer = 1
     meshGenerator.NumberOfSubLayers = 2
     meshGenerator.BoundaryLayerOnCaps = 0
-    meshGenerator.BoundaryLayerThicknessFactor = Solid_thickness / TargetEdgeLength 
+    meshGenerator.BoundaryLayerThicknessFactor = Solid_thickness / TargetEdgeLength
     meshGenerator.SubLayerRatio = 1
     meshGenerator.Tetrahedralize = 1
     meshGenerator.VolumeElementScaleFactor = 0.8
@@ -85,9 +108,124 @@ def generate_mesh_fsi(surface, Solid_thickness, TargetEdgeLength):
 
     return mesh, remeshSurface
 
-def write_mesh(compress_mesh, file_name_surface_name, file_name_vtu_mesh, file_name_xml_mesh, mesh, remeshed_surface):
+def get_cached_polydata(filename, compute, existing_files=None):
+    """
+    Read a polydata from file if it exists, otherwise compute it and write it to file.
+    Args:
+        filename (str): Path to the cached polydata, with extension .vtp
+        compute (callable): Function without arguments returning the polydata
+        existing_files (set): Names of the files in the folder of filename. If None, the file system is checked.
+    Returns:
+        polydata (vtkPolyData): Cached or newly computed polydata
     """
-    Writes the mesh to DOLFIN format, and compresses to .gz format
+    if existing_files is None:
+        is_cached = path.isfile(filename)
+    else:
+        is_cached = path.basename(filename) in existing_files
+
+    if is_cached:
+        return read_polydata(filename)
+
+    polydata = compute()
+    write_xml_data(polydata, filename)
+
+    return polydata
+
+def write_polydata_in_background(polydata, filename):
+    """
+    Write a polydata to file in a separate thread. The thread writes a deep copy, so that the input can be
+    used by other VTK filters while it is being written.
+    Args:
+        polydata (vtkPolyData): Polydata to be written
+        filename (str): Path to the output file, with extension .vtp
+    Returns:
+        writer_future (Future): Future of the write. Call result() before the file is used, to wait for the
+            write and raise any error from it.
+    """
+    polydata_copy = vtk.vtkPolyData()
+    polydata_copy.DeepCopy(polydata)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    writer_future = executor.submit(write_xml_data, polydata_copy, filename)
+    # The submitted write still runs to completion, the executor only stops accepting new work
+    executor.shutdown(wait=False)
+
+    return writer_future
+
+def write_xml_data(data, filename, binary=True, compression_level=1):
+    """
+    Write a surface or mesh to a VTK XML file, storing the data arrays as raw binary appended data.
+    Args:
+        data (vtkPolyData or vtkUnstructuredGrid): Surface or mesh to be written
+        filename (str): Path to the output file, with extension .vtp or .vtu
+        binary (bool): Write the data arrays as raw binary. If False, they are written as ASCII.
+        compression_level (int): zlib compression level of the binary data, from 1 (fastest) to 9 (smallest)
+    """
+    file_type = filename.split(".")[-1]
+    if file_type == "vtp":
+        writer = vtk.vtkXMLPolyDataWriter()
+    elif file_type == "vtu":
+        writer = vtk.vtkXMLUnstructuredGridWriter()
+    else:
+        raise RuntimeError("Unknown file type {}, expected .vtp or .vtu".format(file_type))
+
+    writer.SetFileName(filename)
+    writer.SetInputData(data)
+    if binary:
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        writer.SetCompressorTypeToZLib()
+        writer.GetCompressor().SetCompressionLevel(compression_level)
+        # Compress in large blocks instead of the default 32 kB, giving fewer compressor calls and block headers
+        writer.SetBlockSize(block_size)
+    else:
+        writer.SetDataModeToAscii()
+    writer.Write()
+
+def write_xdmf_mesh(mesh, file_name_xdmf_mesh, compress_mesh, compression_level=1):
+    """
+    Writes the mesh to XDMF format readable by DOLFIN, with the data stored in HDF5. The tetrahedra and their
+    cell entity ids are written to file_name_xdmf_mesh, and the boundary triangles and their cell entity ids
+    to a separate facet marker file with the suffix _boundaries.xdmf, to be read as a MeshValueCollection.
+
+    Args:
+        mesh (vtuUnstructuredGrid): Meshed surface model, with tetrahedral and triangular cells
+        file_name_xdmf_mesh (str): Path to XDMF mesh
+        compress_mesh (bool): Compress the HDF5 data with gzip
+        compression_level (int): gzip compression level, from 1 (fastest) to 9 (smallest)
+    """
+    import meshio
+
+    points = vtk_to_numpy(mesh.GetPoints().GetData())
+    cell_types = vtk_to_numpy(mesh.GetCellTypesArray())
+    connectivity = vtk_to_numpy(mesh.GetCells().GetConnectivityArray())
+    offsets = vtk_to_numpy(mesh.GetCells().GetOffsetsArray())
+    cell_entity_ids = vtk_to_numpy(mesh.GetCellData().GetArray("CellEntityIds"))
+
+    tetra_ids = np.flatnonzero(cell_types == vtk.VTK_TETRA)
+    triangle_ids = np.flatnonzero(cell_types == vtk.VTK_TRIANGLE)
+    if tetra_ids.size + triangle_ids.size != mesh.GetNumberOfCells():
+        raise RuntimeError("Only tetrahedral and triangular cells can be written to XDMF")
+
+    # DOLFIN cannot read mixed topology, so the volume mesh and the facet markers go to separate files,
+    # sharing the same points so that the facets refer to the vertices of the volume mesh
+    file_name_xdmf_boundaries = path.splitext(file_name_xdmf_mesh)[0] + "_boundaries.xdmf"
+    for file_name, cell_type, cell_ids, num_vertices in [(file_name_xdmf_mesh, "tetra", tetra_ids, 4),
+                                                         (file_name_xdmf_boundaries, "triangle", triangle_ids, 3)]:
+        cells = connectivity[offsets[cell_ids, None] + np.arange(num_vertices)]
+        xdmf_mesh = meshio.Mesh(points, [(cell_type, cells)], cell_data={"CellEntityIds": [cell_entity_ids[cell_ids]]})
+        meshio.write(file_name, xdmf_mesh, file_format="xdmf", data_format="HDF",
+                     compression="gzip" if compress_mesh else None, compression_opts=compression_level)
+
+def write_mesh(compress_mesh, file_name_surface_name, file_name_vtu_mesh, file_name_xml_mesh, mesh, remeshed_surface,
+               file_name_xdmf_mesh=None, binary=True, compression_level=1):
+    """
+    Writes the mesh to DOLFIN format, and compresses to .gz format. If file_name_xdmf_mesh is given, the mesh
+    is instead written to XDMF format with HDF5 data, with the boundary markers in a separate _boundaries.xdmf
+    file. The HDF5 data is compressed with gzip if compress_mesh is set.
+
+    All compression uses compression_level. The default, 1, is several times faster than the maximum level 9
+    for large meshes, at the cost of files that are typically less than 10% larger.
 
     Args:
         compress_mesh (bool): Compressed mesh to zipped format
@@ -96,17 +234,31 @@ def write_mesh(compress_mesh, file_name_surface_name, file_name_vtu_mesh, file_n
         file_name_xml_mesh (str): Path to XML mesh
         mesh (vtuUnstructuredGrid): Meshed surface model
         remeshed_surface (vtkPolyData): Remeshed surface model
+        file_name_xdmf_mesh (str): Path to XDMF mesh
+        binary (bool): Write the VTU mesh and remeshed surface in binary. DOLFIN XML is always written as text.
+        compression_level (int): zlib/gzip compression level, from 1 (fastest) to 9 (smallest)
     """
     # Write mesh in VTU format
-    write_polydata(remeshed_surface, file_name_surface_name)
-    write_polydata(mesh, file_name_vtu_mesh)
+    write_xml_data(remeshed_surface, file_name_surface_name, binary=binary, compression_level=compression_level)
+    write_xml_data(mesh, file_name_vtu_mesh, binary=binary, compression_level=compression_level)
+
+    if file_name_xdmf_mesh is not None:
+        write_xdmf_mesh(mesh, file_name_xdmf_mesh, compress_mesh, compression_level=compression_level)
+        return
 
     # Write mesh to FEniCS to format
     meshWriter = vmtkscripts.vmtkMeshWriter()
     meshWriter.CellEntityIdsArrayName = "CellEntityIds"
     meshWriter.Mesh = mesh
     meshWriter.Mode = "ascii"
-    meshWriter.Compressed = compress_mesh
+    meshWriter.Compressed = 0
     meshWriter.WriteRegionMarkers = 1
     meshWriter.OutputFileName = file_name_xml_mesh
     meshWriter.Execute()
+
+    # Compress to .xml.gz here, as vmtkMeshWriter always uses the slowest gzip level
+    if compress_mesh:
+        with open(file_name_xml_mesh, "rb") as xml_file, \
+                gzip.open(file_name_xml_mesh + ".gz", "wb", compresslevel=compression_level) as gz_file:
+            shutil.copyfileobj(xml_file, gz_file, block_size)
+        remove(file_name_xml_mesh)
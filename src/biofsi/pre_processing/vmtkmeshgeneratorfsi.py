@@ -22,7 +22,9 @@
 
 from __future__ import absolute_import  # NEEDS TO STAY AS TOP LEVEL MODULE FOR Py2-3 COMPATIBILITY
 import vtk
+from vtk.util.numpy_support import vtk_to_numpy
 from vmtk import vtkvmtk, vmtkscripts, pypes
+import numpy as np
 import sys
 
 
@@ -109,7 +111,6 @@ class vmtkMeshGeneratorFsi(pypes.pypeScript):
 
     def Execute(self):
 
-        from vmtk import vmtkscripts
         if self.Surface == None:
             self.PrintError('Error: No input surface.')
 
@@ -348,41 +349,42 @@ class vmtkMeshGeneratorFsi(pypes.pypeScript):
             self.Mesh = appendFilter.GetOutput()
 
             if not self.BoundaryLayerOnCaps:
-                cellEntityIdsArray = self.Mesh.GetCellData().GetArray(self.CellEntityIdsArrayName)
+                # Look up the mesh and the surface cell types once, not on every visited cell
+                mesh = self.Mesh
+                surfaceCellTypes = [vtk.VTK_TRIANGLE, vtk.VTK_QUADRATIC_TRIANGLE, vtk.VTK_QUAD]
+                cellEntityIdsArray = mesh.GetCellData().GetArray(self.CellEntityIdsArrayName)
 
                 def VisitNeighbors(i, cellEntityId):
                     cellPointIds = vtk.vtkIdList()
-                    self.Mesh.GetCellPoints(i, cellPointIds)
+                    mesh.GetCellPoints(i, cellPointIds)
                     neighborPointIds = vtk.vtkIdList()
                     neighborPointIds.SetNumberOfIds(1)
                     pointNeighborCellIds = vtk.vtkIdList()
-                    neighborCellIds = vtk.vtkIdList()
 
+                    # Visit the neighbors of each point as they are found, instead of collecting them all first
                     for j in range(cellPointIds.GetNumberOfIds()):
                         neighborPointIds.SetId(0, cellPointIds.GetId(j))
-                        self.Mesh.GetCellNeighbors(i, neighborPointIds, pointNeighborCellIds)
+                        mesh.GetCellNeighbors(i, neighborPointIds, pointNeighborCellIds)
                         for k in range(pointNeighborCellIds.GetNumberOfIds()):
-                            neighborCellIds.InsertNextId(pointNeighborCellIds.GetId(k))
-
-                    for j in range(neighborCellIds.GetNumberOfIds()):
-                        cellId = neighborCellIds.GetId(j)
-                        neighborCellEntityId = cellEntityIdsArray.GetTuple1(cellId)
-                        neighborCellType = self.Mesh.GetCellType(cellId)
-                        if neighborCellType not in [vtk.VTK_TRIANGLE, vtk.VTK_QUADRATIC_TRIANGLE, vtk.VTK_QUAD]:
-                            continue
-                        if neighborCellEntityId != placeholderCellEntityId:
-                            continue
-                        cellEntityIdsArray.SetTuple1(cellId, cellEntityId)
-                        VisitNeighbors(cellId, cellEntityId)
-
-                for i in range(self.Mesh.GetNumberOfCells()):
-                    cellEntityId = cellEntityIdsArray.GetTuple1(i)
-                    cellType = self.Mesh.GetCellType(i)
-                    if cellType not in [vtk.VTK_TRIANGLE, vtk.VTK_QUADRATIC_TRIANGLE, vtk.VTK_QUAD]:
-                        continue
-                    if cellEntityId in [0, 1, placeholderCellEntityId]:
-                        continue
-                    VisitNeighbors(i, cellEntityId)
+                            cellId = pointNeighborCellIds.GetId(k)
+                            neighborCellEntityId = cellEntityIdsArray.GetTuple1(cellId)
+                            if neighborCellEntityId != placeholderCellEntityId:
+                                continue
+                            neighborCellType = mesh.GetCellType(cellId)
+                            if neighborCellType not in surfaceCellTypes:
+                                continue
+                            cellEntityIdsArray.SetTuple1(cellId, cellEntityId)
+                            VisitNeighbors(cellId, cellEntityId)
+
+                # Select the surface cells to start from on the whole arrays at once. Their entity ids are never
+                # changed by VisitNeighbors, which only overwrites placeholder ids.
+                cellTypes = vtk_to_numpy(mesh.GetCellTypesArray())
+                cellEntityIds = vtk_to_numpy(cellEntityIdsArray)
+                surfaceCells = np.isin(cellTypes, surfaceCellTypes)
+                startCells = surfaceCells & ~np.isin(cellEntityIds, [0, 1, placeholderCellEntityId])
+
+                for i in np.flatnonzero(startCells).tolist():
+                    VisitNeighbors(i, cellEntityIdsArray.GetTuple1(i))
 
             self.PrintLog("Assembling final FSI mesh")
             appendFilter2 = vtkvmtk.vtkvmtkAppendFilter()